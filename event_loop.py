@@ -3,27 +3,70 @@
 import collections
 import errno
 import heapq
-import json
+import os
 import random
 import selectors
 import socket as _socket
 import sys
 import time
 
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+try:
+    from select import epoll, EPOLLIN, EPOLLOUT
+except ImportError:
+    # no epoll on macOS and Windows, mimic it on top of selectors
+    EPOLLIN, EPOLLOUT = 1, 4
+
+    class epoll:
+        def __init__(self):
+            self._selector = selectors.DefaultSelector()
+
+        def register(self, fd, eventmask):
+            self._selector.register(
+                fd, (eventmask & EPOLLIN and selectors.EVENT_READ)
+                | (eventmask & EPOLLOUT and selectors.EVENT_WRITE))
+
+        def unregister(self, fd):
+            self._selector.unregister(fd)
+
+        def poll(self, timeout=-1):
+            if timeout < 0:
+                timeout = None
+            return [(key.fd, (mask & selectors.EVENT_READ and EPOLLIN)
+                     | (mask & selectors.EVENT_WRITE and EPOLLOUT))
+                    for key, mask in self._selector.select(timeout)]
+
+        def close(self):
+            self._selector.close()
+
 
 class EventLoop:
     def __init__(self):
         self._queue = Queue()
         self._time = None
+        self._at_exit = []
 
     def run(self, entry_point, *args):
         self._execute(entry_point, *args)
 
-        while not self._queue.is_empty():
-            fn, mask = self._queue.pop(self._time)
-            self._execute(fn, mask)
+        queue = self._queue
+        is_empty, pop, execute = queue.is_empty, queue.pop, self._execute
+        while not is_empty():
+            self._time = hrtime()
+            fn, mask = pop(self._time)
+            execute(fn, mask)
 
-        self._queue.close()
+        for callback in self._at_exit:
+            execute(callback)
+        queue.close()
+
+    def at_exit(self, callback):
+        """ callback runs once there is nothing left to wait for """
+        self._at_exit.append(callback)
 
     def register_fileobj(self, fileobj, callback):
         self._queue.register_fileobj(fileobj, callback)
@@ -37,67 +80,80 @@ class EventLoop:
                                    lambda _: callback())
 
     def _execute(self, callback, *args):
-        self._time = hrtime()
         try:
             callback(*args)  # new callstack starts
         except Exception as err:
             print('Uncaught exception:', err)
-        self._time = hrtime()
 
 
 class Queue:
     def __init__(self):
-        self._selector = selectors.DefaultSelector()
+        self._epoll = epoll()
+        self._callbacks = {}
         self._timers = []
         self._timer_no = 0
         self._ready = collections.deque()
 
     def register_timer(self, tick, callback):
-        timer = (tick, self._timer_no, callback)
+        timer = (int(tick), self._timer_no, callback)
         heapq.heappush(self._timers, timer)
         self._timer_no += 1
 
     def register_fileobj(self, fileobj, callback):
-        self._selector.register(fileobj,
-                selectors.EVENT_READ | selectors.EVENT_WRITE,
-                callback)
+        fd = fileobj.fileno()
+        self._epoll.register(fd, EPOLLIN | EPOLLOUT)
+        self._callbacks[fd] = callback
 
     def unregister_fileobj(self, fileobj):
-        self._selector.unregister(fileobj)
+        fd = fileobj.fileno()
+        self._epoll.unregister(fd)
+        del self._callbacks[fd]
 
     def pop(self, tick):
-        if self._ready:
-            return self._ready.popleft()
-
-        timeout = None
-        if self._timers:
-            timeout = (self._timers[0][0] - tick) / 10e6
-
-        events = self._selector.select(timeout)
-        for key, mask in events:
-            callback = key.data
-            self._ready.append((callback, mask))
-
-        if not self._ready and self._timers:
-            idle = (self._timers[0][0] - tick)
-            if idle > 0:
-                time.sleep(idle / 10e6)
-                return self.pop(tick + idle)
-
-        while self._timers and self._timers[0][0] <= tick:
-            _, _, callback = heapq.heappop(self._timers)
-            self._ready.append((callback, None))
-
-        return self._ready.popleft()
+        ready = self._ready
+        if ready:
+            return ready.popleft()
+
+        poll, callbacks = self._epoll.poll, self._callbacks
+        timers, heappop = self._timers, heapq.heappop
+        while True:
+            timeout = -1
+            next_tick = timers[0][0] if timers else None
+            if next_tick is not None:
+                timeout = (next_tick - tick) / 1e9
+                if timeout < 0:
+                    timeout = 0
+
+            # error and hang-up conditions count as both READ and WRITE
+            events = poll(timeout)
+            if events:
+                ready.extend([
+                    (callbacks[fd],
+                     (ev & ~EPOLLIN and selectors.EVENT_WRITE)
+                     | (ev & ~EPOLLOUT and selectors.EVENT_READ))
+                    for fd, ev in events])
+
+            if not ready and next_tick is not None and next_tick > tick:
+                # poll() has slept until the timer, catch up with the clock
+                tick = hrtime()
+
+            # one heappop per due timer beats re-heapifying after a bulk
+            # partition unless nearly the whole heap has expired at once
+            while timers and timers[0][0] <= tick:
+                ready.append((heappop(timers)[2], None))
+
+            if ready:
+                return ready.popleft()
 
     def is_empty(self):
-        return not (self._ready or self._timers or self._selector.get_map())
+        return not (self._ready or self._timers or self._callbacks)
 
     def close(self):
-        self._selector.close()
+        self._epoll.close()
 
 
 class Context:
+    __slots__ = ()
     _event_loop = None
 
     @classmethod
@@ -120,75 +176,147 @@ class IOError(Exception):
 
 
 def hrtime():
-    """ returns time in microseconds """
-    return int(time.time() * 10e6)
+    """ returns time in nanoseconds """
+    return time.monotonic_ns()
 
 
 class set_timer(Context):
     def __init__(self, duration, callback):
-        """ duration is in microseconds """
+        """ duration is in nanoseconds """
         self.evloop.set_timer(duration, callback)
 
 
+class _RecvWaiter:
+    """ pending recv() of a socket, reused for every call """
+
+    __slots__ = ('sock', 'n', 'user_cb')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.n = 0
+        self.user_cb = None
+
+    def __call__(self, err):
+        callback = self.user_cb
+        if err:
+            self.user_cb = None
+            return callback(err)
+        try:
+            data = os.read(self.sock._fd, self.n)
+        except BlockingIOError:
+            self.sock._cb_recv = self
+            return
+        except OSError as exc:
+            self.user_cb = None
+            return callback(IOError('recv failed',
+                                    exc.errno, errno.errorcode[exc.errno]))
+        self.user_cb = None
+        callback(None, data)
+
+
+class _SendWaiter:
+    """ pending sendall() of a socket, reused for every call """
+
+    __slots__ = ('sock', 'view', 'offset', 'user_cb')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.view = None
+        self.offset = 0
+        self.user_cb = None
+
+    def __call__(self, err):
+        callback = self.user_cb
+        if err:
+            self.view = self.user_cb = None
+            return callback(err)
+        try:
+            self.offset += os.write(self.sock._fd, self.view[self.offset:])
+        except BlockingIOError:
+            pass
+        except OSError as exc:
+            self.view = self.user_cb = None
+            return callback(IOError('send failed',
+                                    exc.errno, errno.errorcode[exc.errno]))
+        if self.offset < len(self.view):
+            self.sock._cb_sent = self
+        else:
+            self.view = self.user_cb = None
+            callback(None)
+
+
 class socket(Context):
+    __slots__ = ('_sock', '_fd', '_state', '_cb_conn', '_cb_recv', '_cb_sent',
+                 '_recv_waiter', '_send_waiter')
+
     def __init__(self, *args):
         self._sock = _socket.socket(*args)
         self._sock.setblocking(False)
+        self._fd = self._sock.fileno()
         self.evloop.register_fileobj(self._sock, self._on_event)
         # 0 - initial
         # 1 - connecting
         # 2 - connected
         # 3 - closed
+        # 4 - suspended
         self._state = 0
-        self._callbacks = {}
+        self._cb_conn = None
+        self._cb_recv = None
+        self._cb_sent = None
+        self._recv_waiter = _RecvWaiter(self)
+        self._send_waiter = _SendWaiter(self)
 
     def connect(self, addr, callback):
         assert self._state == 0
         self._state = 1
-        self._callbacks['conn'] = callback
+        self._cb_conn = callback
         err = self._sock.connect_ex(addr)
         assert errno.errorcode[err] == 'EINPROGRESS'
 
     def recv(self, n, callback):
         assert self._state == 2
-        assert 'recv' not in self._callbacks
-
-        def _on_read_ready(err):
-            if err:
-                return callback(err)
-            data = self._sock.recv(n)
-            callback(None, data)
+        assert self._cb_recv is None
 
-        self._callbacks['recv'] = _on_read_ready
+        waiter = self._recv_waiter
+        waiter.n = n
+        waiter.user_cb = callback
+        self._cb_recv = waiter
 
     def sendall(self, data, callback):
         assert self._state == 2
-        assert 'sent' not in self._callbacks
+        assert self._cb_sent is None
 
-        def _on_write_ready(err):
-            nonlocal data
-            if err:
-                return callback(err)
+        waiter = self._send_waiter
+        waiter.view = memoryview(data)
+        waiter.offset = 0
+        waiter.user_cb = callback
+        self._cb_sent = waiter
 
-            n = self._sock.send(data)
-            if n < len(data):
-                data = data[n:]
-                self._callbacks['sent'] = _on_write_ready
-            else:
-                callback(None)
+    def suspend(self):
+        """ stops watching the connection, e.g. while it sits in a pool """
+        assert self._state == 2
+        self._state = 4
+        self.evloop.unregister_fileobj(self._sock)
 
-        self._callbacks['sent'] = _on_write_ready
+    def resume(self):
+        assert self._state == 4
+        self._state = 2
+        self.evloop.register_fileobj(self._sock, self._on_event)
 
     def close(self):
-        self.evloop.unregister_fileobj(self._sock)
-        self._callbacks.clear()
+        if self._state != 4:
+            self.evloop.unregister_fileobj(self._sock)
+        self._cb_conn = self._cb_recv = self._cb_sent = None
         self._state = 3
         self._sock.close()
 
     def _on_event(self, mask):
         if self._state == 1:
-            assert mask == selectors.EVENT_WRITE
-            cb = self._callbacks.pop('conn')
+            # a failed connect() is reported as READ | WRITE
+            if not mask & selectors.EVENT_WRITE:
+                return
+            cb = self._cb_conn
+            self._cb_conn = None
             err = self._get_sock_error()
             if err:
                 self.close()
@@ -196,19 +324,30 @@ class socket(Context):
                 self._state = 2
             cb(err)
 
-        if mask & selectors.EVENT_READ:
-            cb = self._callbacks.get('recv')
-            if cb:
-                del self._callbacks['recv']
-                err = self._get_sock_error()
-                cb(err)
+        events = mask & (selectors.EVENT_READ | selectors.EVENT_WRITE)
+        self._DISPATCH[events](self)
+
+    def _on_idle(self):
+        pass
+
+    def _on_read(self):
+        cb = self._cb_recv
+        if cb is not None:
+            self._cb_recv = None
+            cb(self._get_sock_error())
+
+    def _on_write(self):
+        cb = self._cb_sent
+        if cb is not None:
+            self._cb_sent = None
+            cb(self._get_sock_error())
 
-        if mask & selectors.EVENT_WRITE:
-            cb = self._callbacks.get('sent')
-            if cb:
-                del self._callbacks['sent']
-                err = self._get_sock_error()
-                cb(err)
+    def _on_read_write(self):
+        self._on_read()
+        self._on_write()
+
+    # indexed by the event mask, EVENT_READ == 1 and EVENT_WRITE == 2
+    _DISPATCH = (_on_idle, _on_read, _on_write, _on_read_write)
 
     def _get_sock_error(self):
         err = self._sock.getsockopt(_socket.SOL_SOCKET,
@@ -220,39 +359,97 @@ class socket(Context):
 
 ###############################################################################
 
-class Client:
+class Client(Context):
+    _pools = {}  # event loop -> addr -> idle sockets
+    _GET_USER = b'GET user %d\n'
+    _GET_ACCOUNT = b'GET account %d\n'
+
     def __init__(self, addr):
         self.addr = addr
 
     def get_user(self, user_id, callback):
-        self._get(f'GET user {user_id}\n', callback)
+        self._get(self._GET_USER % int(user_id), callback)
 
     def get_balance(self, account_id, callback):
-        self._get(f'GET account {account_id}\n', callback)
+        self._get(self._GET_ACCOUNT % int(account_id), callback)
+
+    def _idle(self):
+        evloop = self.evloop
+        pool = self._pools.get(evloop)
+        if pool is None:
+            pool = collections.defaultdict(collections.deque)
+            self._pools[evloop] = pool
+            evloop.at_exit(lambda: self._drain(evloop))
+        return pool[self.addr]
+
+    @classmethod
+    def _drain(cls, evloop):
+        for idle in cls._pools.pop(evloop).values():
+            while idle:
+                idle.pop().close()
 
     def _get(self, req, callback):
+        idle = self._idle()
+        if idle:
+            sock = idle.pop()
+            sock.resume()
+            return self._request(sock, req, callback, retry=True)
+        self._connect(req, callback)
+
+    def _connect(self, req, callback):
         sock = socket(_socket.AF_INET, _socket.SOCK_STREAM)
 
         def _on_conn(err):
             if err:
                 return callback(err)
+            self._request(sock, req, callback)
+
+        sock.connect(self.addr, _on_conn)
 
-            def _on_sent(err):
+    def _request(self, sock, req, callback, retry=False):
+        resp = b''
+
+        def _on_error(err):
+            sock.close()
+            if retry:
+                # the pooled connection has gone stale, try a fresh one
+                return self._connect(req, callback)
+            callback(err)
+
+        def _on_sent(err):
+            if err:
+                return _on_error(err)
+
+            def _on_resp(err, chunk=None):
+                nonlocal resp
                 if err:
+                    return _on_error(err)
+                if not chunk:
+                    return _on_error(_closed_error())
+
+                # replies are newline-terminated, only a complete one
+                # leaves the connection clean enough to be pooled
+                resp += chunk
+                if not resp.endswith(b'\n'):
+                    return sock.recv(1024, _on_resp)
+
+                try:
+                    data = json.loads(resp)
+                except ValueError as err:
                     sock.close()
                     return callback(err)
+                sock.suspend()
+                self._idle().append(sock)
+                callback(None, data)
 
-                def _on_resp(err, resp=None):
-                    sock.close()
-                    if err:
-                        return callback(err)
-                    callback(None, json.loads(resp))
+            sock.recv(1024, _on_resp)
 
-                sock.recv(1024, _on_resp)
+        sock.sendall(req, _on_sent)
 
-            sock.sendall(req.encode('utf8'), _on_sent)
 
-        sock.connect(self.addr, _on_conn)
+def _closed_error():
+    return IOError('connection closed by peer',
+                   errno.ECONNRESET, errno.errorcode[errno.ECONNRESET])
 
 
 def get_user_balance(serv_addr, user_id, done):
@@ -275,7 +472,7 @@ def get_user_balance(serv_addr, user_id, done):
 
         client.get_user(user_id, on_user)
 
-    set_timer(random.randint(0, 10e6), on_timer)
+    set_timer(random.randint(0, 1_000_000_000), on_timer)
 
 
 def main1(serv_addr):
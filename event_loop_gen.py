@@ -2,8 +2,9 @@
 
 import collections
 import errno
+import functools
 import heapq
-import json
+import os
 import random
 import selectors
 import socket as _socket
@@ -11,20 +12,63 @@ import sys
 import time
 import types
 
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+try:
+    from select import epoll, EPOLLIN, EPOLLOUT
+except ImportError:
+    # no epoll on macOS and Windows, mimic it on top of selectors
+    EPOLLIN, EPOLLOUT = 1, 4
+
+    class epoll:
+        def __init__(self):
+            self._selector = selectors.DefaultSelector()
+
+        def register(self, fd, eventmask):
+            self._selector.register(
+                fd, (eventmask & EPOLLIN and selectors.EVENT_READ)
+                | (eventmask & EPOLLOUT and selectors.EVENT_WRITE))
+
+        def unregister(self, fd):
+            self._selector.unregister(fd)
+
+        def poll(self, timeout=-1):
+            if timeout < 0:
+                timeout = None
+            return [(key.fd, (mask & selectors.EVENT_READ and EPOLLIN)
+                     | (mask & selectors.EVENT_WRITE and EPOLLOUT))
+                    for key, mask in self._selector.select(timeout)]
+
+        def close(self):
+            self._selector.close()
+
 
 class EventLoop:
     def __init__(self):
         self._queue = Queue()
         self._time = None
+        self._at_exit = []
 
     def run(self, entry_point, *args):
         self._execute(entry_point, *args)
 
-        while not self._queue.is_empty():
-            fn, mask = self._queue.pop(self._time)
-            self._execute(fn, mask)
+        queue = self._queue
+        is_empty, pop, execute = queue.is_empty, queue.pop, self._execute
+        while not is_empty():
+            self._time = hrtime()
+            fn, mask = pop(self._time)
+            execute(fn, mask)
 
-        self._queue.close()
+        for callback in self._at_exit:
+            execute(callback)
+        queue.close()
+
+    def at_exit(self, callback):
+        """ callback runs once there is nothing left to wait for """
+        self._at_exit.append(callback)
 
     def register_fileobj(self, fileobj, callback):
         self._queue.register_fileobj(fileobj, callback)
@@ -40,7 +84,6 @@ class EventLoop:
         return p
 
     def _execute(self, callback, *args):
-        self._time = hrtime()
         try:
             ret = callback(*args)
             if is_generator(ret):
@@ -50,62 +93,76 @@ class EventLoop:
 
         except Exception as err:
             print('Uncaught exception:', err)
-        self._time = hrtime()
 
 
 class Queue:
     def __init__(self):
-        self._selector = selectors.DefaultSelector()
+        self._epoll = epoll()
+        self._callbacks = {}
         self._timers = []
         self._timer_no = 0
         self._ready = collections.deque()
 
     def register_timer(self, tick, callback):
-        timer = (tick, self._timer_no, callback)
+        timer = (int(tick), self._timer_no, callback)
         heapq.heappush(self._timers, timer)
         self._timer_no += 1
 
     def register_fileobj(self, fileobj, callback):
-        self._selector.register(fileobj,
-                selectors.EVENT_READ | selectors.EVENT_WRITE,
-                callback)
+        fd = fileobj.fileno()
+        self._epoll.register(fd, EPOLLIN | EPOLLOUT)
+        self._callbacks[fd] = callback
 
     def unregister_fileobj(self, fileobj):
-        self._selector.unregister(fileobj)
+        fd = fileobj.fileno()
+        self._epoll.unregister(fd)
+        del self._callbacks[fd]
 
     def pop(self, tick):
-        if self._ready:
-            return self._ready.popleft()
-
-        timeout = None
-        if self._timers:
-            timeout = (self._timers[0][0] - tick) / 10e6
-
-        events = self._selector.select(timeout)
-        for key, mask in events:
-            callback = key.data
-            self._ready.append((callback, mask))
-
-        if not self._ready and self._timers:
-            idle = (self._timers[0][0] - tick)
-            if idle > 0:
-                time.sleep(idle / 10e6)
-                return self.pop(tick + idle)
-
-        while self._timers and self._timers[0][0] <= tick:
-            _, _, callback = heapq.heappop(self._timers)
-            self._ready.append((callback, None))
-
-        return self._ready.popleft()
+        ready = self._ready
+        if ready:
+            return ready.popleft()
+
+        poll, callbacks = self._epoll.poll, self._callbacks
+        timers, heappop = self._timers, heapq.heappop
+        while True:
+            timeout = -1
+            next_tick = timers[0][0] if timers else None
+            if next_tick is not None:
+                timeout = (next_tick - tick) / 1e9
+                if timeout < 0:
+                    timeout = 0
+
+            # error and hang-up conditions count as both READ and WRITE
+            events = poll(timeout)
+            if events:
+                ready.extend([
+                    (callbacks[fd],
+                     (ev & ~EPOLLIN and selectors.EVENT_WRITE)
+                     | (ev & ~EPOLLOUT and selectors.EVENT_READ))
+                    for fd, ev in events])
+
+            if not ready and next_tick is not None and next_tick > tick:
+                # poll() has slept until the timer, catch up with the clock
+                tick = hrtime()
+
+            # one heappop per due timer beats re-heapifying after a bulk
+            # partition unless nearly the whole heap has expired at once
+            while timers and timers[0][0] <= tick:
+                ready.append((heappop(timers)[2], None))
+
+            if ready:
+                return ready.popleft()
 
     def is_empty(self):
-        return not (self._ready or self._timers or self._selector.get_map())
+        return not (self._ready or self._timers or self._callbacks)
 
     def close(self):
-        self._selector.close()
+        self._epoll.close()
 
 
 class Context:
+    __slots__ = ()
     _event_loop = None
 
     @classmethod
@@ -118,48 +175,62 @@ class Context:
 
 
 def unwind(gen, ok, fail, ret=None, method='send'):
-    try:
-        ret = getattr(gen, method)(ret)
-    except StopIteration as stop:
-        return ok(stop.value)
-    except Exception as e:
-        return fail(e)
-
-    if is_generator(ret):
-        unwind(ret,
-               ok=lambda x: unwind(gen, ok, fail, x),
-               fail=lambda e: unwind(gen, ok, fail, e, 'throw'))
-    elif is_promise(ret):
-        ret.then(lambda x=None: unwind(gen, ok, fail, x)) \
-           .catch(lambda e: unwind(gen, ok, fail, e, 'throw'))
+    _unwind([gen], ok, fail, ret, method)
+
+
+def _unwind(stack, ok, fail, ret, method):
+    # Nested generators are driven by this loop instead of recursion,
+    # only a yielded promise (or a collection) suspends the whole chain.
+    while stack:
+        try:
+            ret = getattr(stack[-1], method)(ret)
+            method = 'send'
+        except StopIteration as stop:
+            stack.pop()
+            ret, method = stop.value, 'send'
+            continue
+        except Exception as e:
+            stack.pop()
+            ret, method = e, 'throw'
+            continue
+
+        if is_generator(ret):
+            stack.append(ret)
+            ret = None
+            continue
+
+        resume = lambda x=None: _unwind(stack, ok, fail, x, 'send')
+        throw = lambda e: _unwind(stack, ok, fail, e, 'throw')
+        if is_promise(ret):
+            ret.then(resume).catch(throw)
+        else:
+            wait_all(ret, resume, throw)
+        return
+
+    if method == 'throw':
+        fail(ret)
     else:
-        wait_all(ret,
-                lambda x=None: unwind(gen, ok, fail, x),
-                lambda e: unwind(gen, ok, fail, e, 'throw'))
+        ok(ret)
 
 
 def wait_all(col, ok, fail):
     counter = len(col)
     results = [None] * counter
 
-    def _resolve_single(i):
-
-        def _do_resolve(val):
-            nonlocal counter
-            results[i] = val
-            counter -= 1
-            if counter == 0:
-                ok(results)
-
-        return _do_resolve
+    def _resolve_single(i, val):
+        nonlocal counter
+        results[i] = val
+        counter -= 1
+        if counter == 0:
+            ok(results)
 
     for i, c in enumerate(col):
         if is_generator(c):
-            unwind(c, ok=_resolve_single(i), fail=fail)
+            unwind(c, ok=functools.partial(_resolve_single, i), fail=fail)
             continue
 
         if is_promise(c):
-            c.then(_resolve_single(i)).catch(fail)
+            c.then(functools.partial(_resolve_single, i)).catch(fail)
             continue
 
         raise Exception('Only promise or generator '
@@ -176,8 +247,9 @@ def is_promise(val):
 
 class Promise(Context):
     def __init__(self):
-        self._on_resolve = []
-        self._on_reject = []
+        # a single callback or a list of them once there is more than one
+        self._on_resolve = None
+        self._on_reject = None
         self._resolved = False
         self._rejected = False
         self._value = None
@@ -191,19 +263,16 @@ class Promise(Context):
             return pall
 
         results = [None] * counter
-        def _on_single_resolved(i):
-            def _cb(*args):
-                nonlocal counter
-
-                results[i] = args
-                counter -= 1
-                if counter == 0:
-                    pall._resolve(results)
+        def _on_single_resolved(i, *args):
+            nonlocal counter
 
-            return _cb
+            results[i] = args
+            counter -= 1
+            if counter == 0:
+                pall._resolve(results)
 
         for idx, p in enumerate(promises):
-            p.then(_on_single_resolved(idx))
+            p.then(functools.partial(_on_single_resolved, idx))
             p.catch(pall._reject)
 
         return pall
@@ -212,14 +281,24 @@ class Promise(Context):
         if self._resolved:
             self.evloop._execute(cb, *self._value)
         elif not self._rejected:
-            self._on_resolve.append(cb)
+            if self._on_resolve is None:
+                self._on_resolve = cb
+            elif callable(self._on_resolve):
+                self._on_resolve = [self._on_resolve, cb]
+            else:
+                self._on_resolve.append(cb)
         return self
 
     def catch(self, cb):
         if self._rejected:
             self.evloop._execute(cb, self._value)
         elif not self._resolved:
-            self._on_reject.append(cb)
+            if self._on_reject is None:
+                self._on_reject = cb
+            elif callable(self._on_reject):
+                self._on_reject = [self._on_reject, cb]
+            else:
+                self._on_reject.append(cb)
         return self
 
     def _resolve(self, *args):
@@ -228,6 +307,11 @@ class Promise(Context):
 
         self._resolved = True
         self._value = args
+        if self._on_resolve is None:
+            return
+        if callable(self._on_resolve):
+            self.evloop._execute(self._on_resolve, *args)
+            return
         for cb in self._on_resolve:
             self.evloop._execute(cb, *args)
 
@@ -236,6 +320,11 @@ class Promise(Context):
             return
         self._rejected = True
         self._value = err
+        if self._on_reject is None:
+            return
+        if callable(self._on_reject):
+            self._on_reject(err)
+            return
         for cb in self._on_reject:
             cb(err)
 
@@ -251,24 +340,32 @@ class IOError(Exception):
 
 
 def hrtime():
-    return int(time.time() * 10e6)
+    """ returns time in nanoseconds """
+    return time.monotonic_ns()
 
 
 def sleep(duration):
-    return Context._event_loop.set_timer(duration * 10e3)
+    """ duration is in milliseconds """
+    return Context._event_loop.set_timer(int(duration * 1_000_000))
 
 
 class socket(Context):
+    __slots__ = ('_sock', '_fd', '_state', '_cb_conn', '_cb_recv', '_cb_sent')
+
     def __init__(self, *args):
         self._sock = _socket.socket(*args)
         self._sock.setblocking(False)
+        self._fd = self._sock.fileno()
         self.evloop.register_fileobj(self._sock, self._on_event)
         # 0 - initial
         # 1 - connecting
         # 2 - connected
         # 3 - closed
+        # 4 - suspended
         self._state = 0
-        self._callbacks = {}
+        self._cb_conn = None
+        self._cb_recv = None
+        self._cb_sent = None
 
     def connect(self, addr):
         assert self._state == 0
@@ -281,56 +378,85 @@ class socket(Context):
             else:
                 p._resolve()
 
-        self._callbacks['conn'] = _on_conn
+        self._cb_conn = _on_conn
         err = self._sock.connect_ex(addr)
         assert errno.errorcode[err] == 'EINPROGRESS'
         return p
 
     def recv(self, n):
         assert self._state == 2
-        assert 'recv' not in self._callbacks
+        assert self._cb_recv is None
 
         p = Promise()
         def _on_read_ready(err):
             if err:
-                p._reject(err)
-            else:
-                data = self._sock.recv(n)
-                p._resolve(data)
-
-        self._callbacks['recv'] = _on_read_ready
+                return p._reject(err)
+            try:
+                data = os.read(self._fd, n)
+            except BlockingIOError:
+                self._cb_recv = _on_read_ready
+                return
+            except OSError as exc:
+                return p._reject(IOError('recv failed', exc.errno,
+                                         errno.errorcode[exc.errno]))
+            p._resolve(data)
+
+        self._cb_recv = _on_read_ready
         return p
 
     def sendall(self, data):
         assert self._state == 2
-        assert 'sent' not in self._callbacks
+        assert self._cb_sent is None
 
         p = Promise()
+        view = memoryview(data)
+        offset = 0
+
         def _on_write_ready(err):
-            nonlocal data
+            nonlocal offset
             if err:
                 return p._reject(err)
 
-            n = self._sock.send(data)
-            if n < len(data):
-                data = data[n:]
-                self._callbacks['sent'] = _on_write_ready
+            try:
+                offset += os.write(self._fd, view[offset:])
+            except BlockingIOError:
+                pass
+            except OSError as exc:
+                return p._reject(IOError('send failed', exc.errno,
+                                         errno.errorcode[exc.errno]))
+            if offset < len(view):
+                self._cb_sent = _on_write_ready
             else:
                 p._resolve(None)
 
-        self._callbacks['sent'] = _on_write_ready
+        self._cb_sent = _on_write_ready
         return p
 
-    def close(self):
+    def suspend(self):
+        """ stops watching the connection, e.g. while it sits in a pool """
+        assert self._state == 2
+        self._state = 4
         self.evloop.unregister_fileobj(self._sock)
-        self._callbacks.clear()
+
+    def resume(self):
+        assert self._state == 4
+        self._state = 2
+        self.evloop.register_fileobj(self._sock, self._on_event)
+
+    def close(self):
+        if self._state != 4:
+            self.evloop.unregister_fileobj(self._sock)
+        self._cb_conn = self._cb_recv = self._cb_sent = None
         self._state = 3
         self._sock.close()
 
     def _on_event(self, mask):
         if self._state == 1:
-            assert mask == selectors.EVENT_WRITE
-            cb = self._callbacks.pop('conn')
+            # a failed connect() is reported as READ | WRITE
+            if not mask & selectors.EVENT_WRITE:
+                return
+            cb = self._cb_conn
+            self._cb_conn = None
             err = self._get_sock_error()
             if err:
                 self.close()
@@ -338,19 +464,30 @@ class socket(Context):
                 self._state = 2
             cb(err)
 
-        if mask & selectors.EVENT_READ:
-            cb = self._callbacks.get('recv')
-            if cb:
-                del self._callbacks['recv']
-                err = self._get_sock_error()
-                cb(err)
+        events = mask & (selectors.EVENT_READ | selectors.EVENT_WRITE)
+        self._DISPATCH[events](self)
+
+    def _on_idle(self):
+        pass
 
-        if mask & selectors.EVENT_WRITE:
-            cb = self._callbacks.get('sent')
-            if cb:
-                del self._callbacks['sent']
-                err = self._get_sock_error()
-                cb(err)
+    def _on_read(self):
+        cb = self._cb_recv
+        if cb is not None:
+            self._cb_recv = None
+            cb(self._get_sock_error())
+
+    def _on_write(self):
+        cb = self._cb_sent
+        if cb is not None:
+            self._cb_sent = None
+            cb(self._get_sock_error())
+
+    def _on_read_write(self):
+        self._on_read()
+        self._on_write()
+
+    # indexed by the event mask, EVENT_READ == 1 and EVENT_WRITE == 2
+    _DISPATCH = (_on_idle, _on_read, _on_write, _on_read_write)
 
     def _get_sock_error(self):
         err = self._sock.getsockopt(_socket.SOL_SOCKET,
@@ -362,25 +499,73 @@ class socket(Context):
 
 ###############################################################################
 
-class Client:
+class Client(Context):
+    _pools = {}  # event loop -> addr -> idle sockets
+    _GET_USER = b'GET user %d\n'
+    _GET_ACCOUNT = b'GET account %d\n'
+
     def __init__(self, addr):
         self.addr = addr
 
     def get_user(self, user_id):
-        return self._get(f'GET user {user_id}\n')
+        return self._get(self._GET_USER % int(user_id))
 
     def get_balance(self, account_id):
-        return self._get(f'GET account {account_id}\n')
+        return self._get(self._GET_ACCOUNT % int(account_id))
+
+    def _idle(self):
+        evloop = self.evloop
+        pool = self._pools.get(evloop)
+        if pool is None:
+            pool = collections.defaultdict(collections.deque)
+            self._pools[evloop] = pool
+            evloop.at_exit(lambda: self._drain(evloop))
+        return pool[self.addr]
+
+    @classmethod
+    def _drain(cls, evloop):
+        for idle in cls._pools.pop(evloop).values():
+            while idle:
+                idle.pop().close()
 
     def _get(self, req):
+        idle = self._idle()
+        if idle:
+            sock = idle.pop()
+            sock.resume()
+            try:
+                return (yield self._request(sock, req))
+            except IOError:
+                pass  # the pooled connection has gone stale, try a fresh one
+
         sock = socket(_socket.AF_INET, _socket.SOCK_STREAM)
         yield sock.connect(self.addr)
+        return (yield self._request(sock, req))
+
+    def _request(self, sock, req):
         try:
-            yield sock.sendall(req.encode('utf8'))
-            resp = yield sock.recv(1024)
-            return json.loads(resp)
-        finally:
+            yield sock.sendall(req)
+            # replies are newline-terminated, only a complete one
+            # leaves the connection clean enough to be pooled
+            resp = b''
+            while not resp.endswith(b'\n'):
+                chunk = yield sock.recv(1024)
+                if not chunk:
+                    raise _closed_error()
+                resp += chunk
+            data = json.loads(resp)
+        except BaseException:
             sock.close()
+            raise
+
+        sock.suspend()
+        self._idle().append(sock)
+        return data
+
+
+def _closed_error():
+    return IOError('connection closed by peer',
+                   errno.ECONNRESET, errno.errorcode[errno.ECONNRESET])
 
 
 def get_user_balance(serv_addr, user_id):
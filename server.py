@@ -1,15 +1,25 @@
 # python 3
 
-import json
 import random
+import re
 import sys
-from socketserver import BaseRequestHandler, TCPServer
+import threading
+from socketserver import BaseRequestHandler, ThreadingTCPServer
 from uuid import uuid4
 
 
+_REQ_RE = re.compile(rb'GET (user|account) (\d+)\n\Z')
+
+# ids and names never need escaping, so responses are formatted directly;
+# the trailing newline tells the client where a response ends
+_USER_RESP = b'{"id":"%b","name":"%b","account_id":"%b"}\n'
+_ACCOUNT_RESP = b'{"id":"%b","balance":%d}\n'
+
+
 class Handler(BaseRequestHandler):
     users = {}
     accounts = {}
+    lock = threading.Lock()
 
     def handle(self):
         client = f'client {self.client_address}'
@@ -18,46 +28,54 @@ class Handler(BaseRequestHandler):
             print(f'{client} unexpectedly disconnected')
             return
 
-        print(f'{client} < {req}')
-        req = req.decode('utf8')
-        if req[-1] != '\n':
+        # the connection is kept open until the client closes it
+        while req:
+            print(f'{client} < {req}')
+            self.respond(req)
+            req = self.request.recv(1024)
+
+    def respond(self, req):
+        if not req.endswith(b'\n'):
             raise Exception('Max request length exceeded')
 
-        method, entity_kind, entity_id = req[:-1].split(' ', 3)
-        if (method != 'GET'
-           or entity_kind not in ('user', 'account')
-           or not entity_id.isdigit()):
+        match = _REQ_RE.match(req)
+        if match is None:
             raise Exception('Bad request')
+        entity_kind, entity_id = match.group(1), match.group(2).decode()
 
-        if entity_kind == 'user':
-            user = self.users.get(entity_id) or {'id': entity_id}
-            self.users[entity_id] = user
+        if entity_kind == b'user':
+            with self.lock:
+                user = self.users.get(entity_id) or {'id': entity_id}
+                self.users[entity_id] = user
 
-            if 'name' not in user:
-                user['name'] = str(uuid4()).split('-')[0]
+                if 'name' not in user:
+                    user['name'] = str(uuid4()).split('-')[0]
 
-            if 'account_id' not in user:
-                account_id = str(len(self.accounts) + 1)
-                account = {'id': account_id,
-                           'balance': random.randint(0, 100)}
-                self.accounts[account_id] = account
-                user['account_id'] = account_id
-            self.send(user)
+                if 'account_id' not in user:
+                    account_id = str(len(self.accounts) + 1)
+                    account = {'id': account_id,
+                               'balance': random.randint(0, 100)}
+                    self.accounts[account_id] = account
+                    user['account_id'] = account_id
+            self.send(_USER_RESP % (user['id'].encode(),
+                                    user['name'].encode(),
+                                    user['account_id'].encode()))
             return
 
-        if entity_kind == 'account':
+        if entity_kind == b'account':
             account = self.accounts[entity_id]
-            self.send(account)
+            self.send(_ACCOUNT_RESP % (account['id'].encode(),
+                                       account['balance']))
             return
 
-    def send(self, data):
-        resp = json.dumps(data).encode('utf8')
+    def send(self, resp):
         print(f'client {self.client_address} > {resp}')
         self.request.sendall(resp)
 
 
 if __name__ == '__main__':
     port = int(sys.argv[1])
-    with TCPServer(('127.0.0.1', port), Handler) as server:
+    with ThreadingTCPServer(('127.0.0.1', port), Handler) as server:
+        server.daemon_threads = True
         server.serve_forever()
 